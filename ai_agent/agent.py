@@ -12,27 +12,40 @@ import sys
 import json
 import time
 import base64
+import asyncio
+import hashlib
+import re
 import argparse
+import functools
 from pathlib import Path
-from typing import Union
-import requests
-import yaml
+import importlib.util
+from typing import TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    import httpx
 
 BASE_DIR = Path(__file__).resolve().parent
 DEFAULT_PLAN_PATH = BASE_DIR / "tests" / "plan_smoke.yaml"
 REPORTS_DIR = BASE_DIR / "reports"
+CACHE_DIR = BASE_DIR / ".cache"
+ETAG_CACHE_PATH = CACHE_DIR / "github_etags.json"
+LAST_REPORT_HASH_PATH = CACHE_DIR / "last_report.sha256"
 DEFAULT_PROMPT_PATH = BASE_DIR / "prompts" / "bot_system.md"
 
-# Optional: try to import Anthropic (if available in env)
+# Optional: Anthropic SDK (imported lazily in call_anthropic; dry runs never load it)
+HAS_ANTHROPIC = importlib.util.find_spec("anthropic") is not None
+
+# Optional: orjson serializes reports several times faster than stdlib json
 try:
-    from anthropic import Anthropic
-    HAS_ANTHROPIC = True
+    import orjson
+    HAS_ORJSON = True
 except Exception:
-    HAS_ANTHROPIC = False
+    HAS_ORJSON = False
 
 REPO = os.environ.get("GITHUB_REPO") or os.environ.get("GITHUB_REPOSITORY")
 GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
 ANTHROPIC_KEY = os.environ.get("ANTHROPIC_API_KEY")
+CLAUDE_MODEL = os.environ.get("CLAUDE_MODEL", "claude-3-7-sonnet")
 
 prompt_override = os.environ.get("BOT_SYSTEM_PROMPT_PATH")
 if prompt_override:
@@ -41,6 +54,21 @@ else:
     BOT_PROMPT_PATH = DEFAULT_PROMPT_PATH
 
 API_GH = "https://api.github.com"
+API_GQL = f"{API_GH}/graphql"
+
+# GraphQL runs mutation fields in order, so the branch exists before the commit lands on it
+COMMIT_MUTATION = """
+mutation($ref: CreateRefInput!, $commit: CreateCommitOnBranchInput!) {
+  createRef(input: $ref) { ref { name } }
+  createCommitOnBranch(input: $commit) { commit { url } }
+}
+"""
+
+_GH_CLIENT = None
+
+# parsed plans keyed by a digest of the file bytes; callers must not mutate the result
+_YAML_CACHE: dict = {}
+_YAML_CACHE_SIZE = 128
 
 def log(*args, **kwargs):
     print(*args, **kwargs, flush=True)
@@ -49,7 +77,36 @@ def read_yaml(path: Union[str, Path]):
     p = Path(path)
     if not p.exists():
         return {}
-    return yaml.safe_load(p.read_text(encoding="utf-8"))
+    raw = p.read_bytes()
+    key = hashlib.blake2b(raw, digest_size=16).digest()
+    data = _YAML_CACHE.get(key)
+    if data is None:
+        import yaml
+        # libyaml's C loader when available, pure-Python SafeLoader otherwise
+        try:
+            from yaml import CSafeLoader as YamlLoader
+        except ImportError:
+            from yaml import SafeLoader as YamlLoader
+        data = yaml.load(raw, Loader=YamlLoader)
+        if len(_YAML_CACHE) >= _YAML_CACHE_SIZE:
+            _YAML_CACHE.pop(next(iter(_YAML_CACHE)))
+        _YAML_CACHE[key] = data
+    return data
+
+@functools.lru_cache(maxsize=4096)
+def stub_reply(user: str) -> str:
+    """Plausible fake assistant reply; plans often repeat the same user text."""
+    return f"(stub reply) Ответ на: {user}"
+
+def _stub_case(i: int, step: dict, total: int, patterns: dict) -> dict:
+    """Build one fake case; simple heuristics fail the last case of an even-length plan."""
+    user = step.get("user", "<no user text>")
+    reply = stub_reply(user)
+    expect = step.get("expect_regex")
+    ok = not (i == total and i % 2 == 0)
+    if ok and expect:
+        ok = patterns[expect].search(reply) is not None
+    return {"idx": i, "user": user, "reply": reply, "expect": expect, "ok": ok}
 
 def run_stub_plan(plan_path: Union[str, Path]):
     """Simple stub runner that loads YAML and produces a fake report."""
@@ -57,129 +114,229 @@ def run_stub_plan(plan_path: Union[str, Path]):
     plan_path = Path(plan_path)
     name = plan.get("name", plan_path.stem)
     steps = plan.get("steps", [])
-    results = {"plan": name, "cases": [], "passed": 0, "failed": 0}
-    for i, s in enumerate(steps, start=1):
-        user = s.get("user", "<no user text>")
-        expect = s.get("expect_regex")
-        # make a plausible reply
-        reply = f"(stub reply) Ответ на: {user}"
-        ok = True
-        if expect and "покажи" in (user or "").lower():
-            ok = True
-        # simple heuristics for failing one case
-        if i == len(steps) and i % 2 == 0:
-            ok = False
-        results["cases"].append({"idx": i, "user": user, "reply": reply, "expect": expect, "ok": ok})
-        if ok:
-            results["passed"] += 1
-        else:
-            results["failed"] += 1
-    return results
-
-def call_anthropic(system_prompt: str, user_text: str):
+    total = len(steps)
+    # compile each distinct expectation once, not once per case
+    patterns = {pat: re.compile(pat) for pat in {s.get("expect_regex") for s in steps} if pat}
+    cases = [_stub_case(i, s, total, patterns) for i, s in enumerate(steps, start=1)]
+    passed = sum(1 for c in cases if c["ok"])
+    return {"plan": name, "cases": cases, "passed": passed, "failed": len(cases) - passed}
+
+def dump_report(report: dict) -> bytes:
+    """Serialize a report once, as UTF-8 bytes, for both the local file and the PR body."""
+    if HAS_ORJSON:
+        # same layout as json.dumps(indent=2); orjson emits UTF-8 bytes directly
+        return orjson.dumps(report, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(report, ensure_ascii=False, indent=2).encode("utf-8")
+
+@functools.lru_cache(maxsize=None)
+def max_tokens() -> int:
+    """MAX_TOKENS from env, parsed once on the first LLM call so a bad value cannot break a dry run."""
+    return int(os.environ.get("MAX_TOKENS", "1024"))
+
+async def call_anthropic(system_prompt: str, user_text: str):
     """Call Anthropic if available. Returns assistant text or raises."""
     if not ANTHROPIC_KEY:
         raise RuntimeError("No ANTHROPIC_API_KEY in env")
     if not HAS_ANTHROPIC:
         raise RuntimeError("Anthropic SDK not installed in environment")
-    client = Anthropic(api_key=ANTHROPIC_KEY)
-    # Use messages API if available, otherwise fallback to completion
+    from anthropic import AsyncAnthropic
+    client = AsyncAnthropic(api_key=ANTHROPIC_KEY)
     try:
-        resp = client.messages.create(
-            model=os.getenv("CLAUDE_MODEL", "claude-3-7-sonnet"),
+        # stream so partial output survives an interrupted generation
+        parts = []
+        async with client.messages.stream(
+            model=CLAUDE_MODEL,
             system=system_prompt,
             messages=[{"role": "user", "content": user_text}],
-            max_tokens=int(os.getenv("MAX_TOKENS", "1024")),
+            max_tokens=max_tokens(),
+        ) as stream:
+            async for text in stream.text_stream:
+                parts.append(text)
+        return "".join(parts).strip()
+    finally:
+        await client.close()
+
+def github_client() -> httpx.AsyncClient:
+    """Shared keep-alive client for GitHub API calls (created on first use)."""
+    global _GH_CLIENT
+    if _GH_CLIENT is None:
+        import httpx
+        _GH_CLIENT = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {GITHUB_TOKEN}", "Accept": "application/vnd.github+json"},
+            # with an explicit transport httpx ignores the client's http2/limits, so they go here
+            transport=httpx.AsyncHTTPTransport(
+                retries=3,
+                # HTTP/2 multiplexes concurrent calls over one connection; needs the `h2` package
+                http2=importlib.util.find_spec("h2") is not None,
+                limits=httpx.Limits(max_keepalive_connections=10),
+            ),
+            timeout=httpx.Timeout(30.0, connect=10.0),
         )
-        # resp content can be a list of blocks or have `content` string
-        if hasattr(resp, "content"):
-            parts = []
-            for block in resp.content:
-                if hasattr(block, "text"):
-                    parts.append(block.text)
-                elif isinstance(block, dict) and block.get("type") == "text":
-                    parts.append(block.get("text", ""))
-            return "\n".join(parts).strip()
-        return str(resp)
-    except Exception as e:
-        raise
+    return _GH_CLIENT
+
+def load_etag_cache() -> dict:
+    """Read the persisted {url: {etag, body}} map; a missing or broken file means empty."""
+    try:
+        return json.loads(ETAG_CACHE_PATH.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+def save_etag_cache(cache: dict):
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    ETAG_CACHE_PATH.write_text(json.dumps(cache, ensure_ascii=False), encoding="utf-8")
+
+GH_RETRY_STATUSES = (429, 502, 503, 504)
+GH_STATUS_RETRIES = 3
+
+async def github_get(url: str, **kwargs):
+    """
+    GET with the status-based retry the old requests adapter had: 429/502/503/504
+    are retried with backoff (honouring Retry-After). The transport's own
+    retries only cover connection failures. POSTs are not retried, as before.
+    """
+    for attempt in range(GH_STATUS_RETRIES + 1):
+        r = await github_client().get(url, **kwargs)
+        if r.status_code not in GH_RETRY_STATUSES or attempt == GH_STATUS_RETRIES:
+            return r
+        retry_after = r.headers.get("Retry-After", "")
+        delay = float(retry_after) if retry_after.isdigit() else 0.3 * 2 ** attempt
+        log(f"GitHub {r.status_code} on {url}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
 
-def save_report_and_create_pr(report: dict, branch_name: str, apply_patches: bool = False):
+async def github_get_cached(url: str, cache: dict) -> dict:
+    """
+    Conditional GET: send the cached ETag as If-None-Match and reuse the cached
+    body on 304 (which does not count against the primary rate limit).
+    """
+    entry = cache.get(url)
+    headers = {"If-None-Match": entry["etag"]} if entry else {}
+    r = await github_get(url, headers=headers)
+    if r.status_code == 304 and entry:
+        return entry["body"]
+    r.raise_for_status()
+    body = r.json()
+    etag = r.headers.get("ETag")
+    if etag:
+        cache[url] = {"etag": etag, "body": body}
+    return body
+
+async def github_graphql(query: str, variables: dict) -> dict:
+    """POST a GraphQL document and return its `data`, raising on GraphQL errors."""
+    r = await github_client().post(API_GQL, json={"query": query, "variables": variables})
+    r.raise_for_status()
+    payload = r.json()
+    if payload.get("errors"):
+        raise RuntimeError(json.dumps(payload["errors"], ensure_ascii=False))
+    return payload["data"]
+
+def file_additions(files: dict) -> list:
+    """Map {path: bytes} to createCommitOnBranch `fileChanges.additions` entries."""
+    return [
+        {"path": path, "contents": base64.b64encode(data).decode("ascii")}
+        for path, data in files.items()
+    ]
+
+async def save_report_and_create_pr(report_json: bytes, branch_name: str, ts: int, apply_patches: bool = False):
     """
     Save reports/suggestions.md and create a branch + draft PR.
+    `report_json` is the already serialized report (see dump_report);
+    `ts` is the run timestamp shared with the branch and report names.
     Requires GITHUB_TOKEN.
     """
     if not GITHUB_TOKEN:
         log("No GITHUB_TOKEN set — skipping PR creation. Saving local report.")
         REPORTS_DIR.mkdir(parents=True, exist_ok=True)
         suggestions_path = REPORTS_DIR / "suggestions.md"
-        suggestions_path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        suggestions_path.write_bytes(report_json)
         return {"pr": None, "saved": str(suggestions_path)}
 
-    # create branch from default (use refs API)
-    headers = {"Authorization": f"Bearer {GITHUB_TOKEN}", "Accept": "application/vnd.github+json"}
-    # get default branch sha
+    # identical report to the last published one — nothing to open a PR for
+    report_hash = hashlib.sha256(report_json).hexdigest()
+    if LAST_REPORT_HASH_PATH.exists() and LAST_REPORT_HASH_PATH.read_text(encoding="utf-8").strip() == report_hash:
+        log("Report unchanged since last PR — skipping branch and PR creation.")
+        return {"pr": None, "unchanged": True}
+
+    gh = github_client()
     repo = REPO or os.environ.get("GITHUB_REPOSITORY")
     if not repo:
         raise RuntimeError("Repository not specified in GITHUB_REPO or GITHUB_REPOSITORY")
     log("Repo:", repo)
 
-    # get default branch
-    r = requests.get(f"{API_GH}/repos/{repo}", headers=headers)
-    r.raise_for_status()
-    default_branch = r.json().get("default_branch", "main")
+    # get default branch and its sha (conditional requests, usually 304);
+    # the ref lookup runs concurrently using last run's default branch as a guess
+    etags = load_etag_cache()
+    repo_url = f"{API_GH}/repos/{repo}"
+    guess = etags.get(repo_url, {}).get("body", {}).get("default_branch", "main")
+    repo_meta, ref = await asyncio.gather(
+        github_get_cached(repo_url, etags),
+        github_get_cached(f"{repo_url}/git/ref/heads/{guess}", etags),
+        return_exceptions=True,
+    )
+    if isinstance(repo_meta, BaseException):
+        raise repo_meta
+    default_branch = repo_meta.get("default_branch", "main")
     log("Default branch:", default_branch)
-    br = requests.get(f"{API_GH}/repos/{repo}/git/ref/heads/{default_branch}", headers=headers)
-    br.raise_for_status()
-    base_sha = br.json()["object"]["sha"]
+    if default_branch != guess or isinstance(ref, BaseException):
+        ref = await github_get_cached(f"{repo_url}/git/ref/heads/{default_branch}", etags)
+    base_sha = ref["object"]["sha"]
+    save_etag_cache(etags)
 
-    new_ref = f"refs/heads/{branch_name}"
-    payload = {"ref": new_ref, "sha": base_sha}
-    r = requests.post(f"{API_GH}/repos/{repo}/git/refs", headers=headers, json=payload)
-    if r.status_code not in (200, 201):
-        # maybe branch exists — continue
-        log("Branch create response:", r.status_code, r.text)
-    else:
-        log("Created branch", branch_name)
-
-    # create file reports/suggestions.md in that branch
-    content = f"# QA Agent report\n\nGenerated at {time.asctime()}\n\n```\n{json.dumps(report, ensure_ascii=False, indent=2)}\n```\n"
-    encoded = base64.b64encode(content.encode("utf-8")).decode("ascii")
-    put_payload = {
-        "message": f"chore(qaa): add suggestions report {int(time.time())}",
-        "content": encoded,
-        "branch": branch_name,
+    # create branch and commit every report artifact in a single mutation
+    header = f"# QA Agent report\n\nGenerated at {time.asctime(time.localtime(ts))}\n\n```\n".encode("ascii")
+    content = b"".join((header, report_json, b"\n```\n"))
+    files = {"ai_agent/reports/suggestions.md": content}
+    variables = {
+        "ref": {"repositoryId": repo_meta["node_id"], "name": f"refs/heads/{branch_name}", "oid": base_sha},
+        "commit": {
+            "branch": {"repositoryNameWithOwner": repo, "branchName": branch_name},
+            "expectedHeadOid": base_sha,
+            "message": {"headline": f"chore(qaa): add suggestions report {ts}"},
+            "fileChanges": {"additions": file_additions(files)},
+        },
     }
-    remote_path = "ai_agent/reports/suggestions.md"
-    r = requests.put(f"{API_GH}/repos/{repo}/contents/{remote_path}", headers=headers, json=put_payload)
-    if r.status_code not in (200, 201):
-        log("Failed to create file in branch:", r.status_code, r.text)
-    else:
-        log("Created reports/suggestions.md in branch")
+    try:
+        data = await github_graphql(COMMIT_MUTATION, variables)
+        log("Created branch", branch_name, f"with {len(files)} file(s) in commit", data["createCommitOnBranch"]["commit"]["url"])
+    except Exception as e:
+        # maybe branch exists — continue
+        log("Failed to create commit in branch:", str(e))
 
     # create draft PR
     pr_payload = {
-        "title": f"QA: auto report {int(time.time())}",
+        "title": f"QA: auto report {ts}",
         "head": branch_name,
         "base": default_branch,
         "body": "Auto-generated QA report. Please review.",
         "draft": True,
     }
-    r = requests.post(f"{API_GH}/repos/{repo}/pulls", headers=headers, json=pr_payload)
+    r = await gh.post(f"{API_GH}/repos/{repo}/pulls", json=pr_payload)
     if r.status_code not in (200, 201):
         log("Failed to create PR:", r.status_code, r.text)
         return {"pr_error": r.text}
     pr = r.json()
     log("Created PR:", pr.get("html_url"))
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    LAST_REPORT_HASH_PATH.write_text(report_hash, encoding="utf-8")
     return {"pr": pr.get("html_url")}
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--plan", default=str(DEFAULT_PLAN_PATH))
-    parser.add_argument("--apply", action="store_true")
-    parser.add_argument("--autodeploy", action="store_true")
-    args = parser.parse_args()
+async def sample_llm_reply(sys_prompt: str):
+    """Fire one sample Anthropic request and log the reply; never raises."""
+    try:
+        log("Calling Anthropic for a sample reply...")
+        sample = await call_anthropic(sys_prompt, "Привет, тестовая просьба.")
+        log("Anthropic sample reply:", sample[:300])
+    except Exception as e:
+        log("Anthropic call failed:", str(e))
+
+async def create_pr(report_json: bytes, branch_name: str, ts: int, apply_patches: bool = False):
+    """Run save_report_and_create_pr, logging failures instead of raising."""
+    try:
+        return await save_report_and_create_pr(report_json, branch_name, ts, apply_patches=apply_patches)
+    except Exception as e:
+        log("PR creation error:", str(e))
+        return {}
 
+async def main_async(args):
     log("Starting agent.py")
     log("Plan:", args.plan)
     log("Anthropic key present:", bool(ANTHROPIC_KEY))
@@ -196,39 +353,48 @@ def main():
         sys_prompt = BOT_PROMPT_PATH.read_text(encoding="utf-8")
         log("Loaded bot system prompt length:", len(sys_prompt))
 
+    use_llm = bool(args.smoke_llm and ANTHROPIC_KEY and HAS_ANTHROPIC)
+    if not use_llm:
+        log("Running in dry-run (stub) mode — no Anthropic calls.")
+
     report = None
     try:
-        if ANTHROPIC_KEY and HAS_ANTHROPIC:
-            # try to call LLM for first step (simple)
-            try:
-                log("Calling Anthropic for a sample reply...")
-                sample = call_anthropic(sys_prompt, "Привет, тестовая просьба.")
-                log("Anthropic sample reply:", sample[:300])
-            except Exception as e:
-                log("Anthropic call failed:", str(e))
-            # For simplicity in this minimal agent we'll still use stub runner for full plan
-            report = run_stub_plan(args.plan)
-        else:
-            log("Running in dry-run (stub) mode — no Anthropic calls.")
-            report = run_stub_plan(args.plan)
+        # For simplicity in this minimal agent we use the stub runner for the full plan
+        report = run_stub_plan(args.plan)
     except Exception as e:
         log("Error running plan:", str(e))
         sys.exit(1)
 
     # save report locally
-    rpt_path = REPORTS_DIR / f"report_{int(time.time())}.json"
-    rpt_path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    # one timestamp for the report file, branch, commit and PR title
+    ts = int(time.time())
+    rpt_path = REPORTS_DIR / f"report_{ts}.json"
+    report_json = dump_report(report)
+    rpt_path.write_bytes(report_json)
     log("Saved report:", rpt_path)
 
-    # create branch and Draft PR
-    branch_name = f"qa/dev-agent/{int(time.time())}"
-    pr_info = {}
+    # create branch and Draft PR while the sample LLM call is in flight
+    branch_name = f"qa/dev-agent/{ts}"
+    jobs = [create_pr(report_json, branch_name, ts, apply_patches=args.apply)]
+    if use_llm:
+        jobs.append(sample_llm_reply(sys_prompt))
     try:
-        pr_info = save_report_and_create_pr(report, branch_name, apply_patches=args.apply)
-    except Exception as e:
-        log("PR creation error:", str(e))
+        pr_info, *_ = await asyncio.gather(*jobs)
+    finally:
+        if _GH_CLIENT is not None:
+            await _GH_CLIENT.aclose()
 
     log("Done. PR info:", pr_info)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--plan", default=str(DEFAULT_PLAN_PATH))
+    parser.add_argument("--apply", action="store_true")
+    parser.add_argument("--autodeploy", action="store_true")
+    parser.add_argument("--smoke-llm", action="store_true", help="send one sample request to Anthropic")
+    args = parser.parse_args()
+
+    asyncio.run(main_async(args))
     # exit 0
     sys.exit(0)
 
@@ -1,46 +1,93 @@
 import os
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.ext import Application, AIORateLimiter, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 import anthropic
 import json
-from datetime import datetime
+import msgspec
+import hashlib
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field, asdict
 from enum import Enum
-import base64
-import io
+from typing import ClassVar
+import time
 import asyncio
-import requests
-import traceback
+import functools
+import httpx
 
 # Получаем токены из переменных окружения
 TELEGRAM_TOKEN = os.environ.get('TELEGRAM_TOKEN')
 ANTHROPIC_API_KEY = os.environ.get('ANTHROPIC_API_KEY')
+REDIS_URL = os.environ.get('REDIS_URL')
+# С PUBLIC_URL бот принимает апдейты вебхуком на PORT, без него - long polling
+PUBLIC_URL = os.environ.get('PUBLIC_URL')
+PORT = int(os.environ.get('PORT', '8443'))
 
 # ========== ИНТЕГРАЦИЯ N8N ==========
 # URL для отправки ошибок в n8n
 N8N_WEBHOOK = "https://noboring.app.n8n.cloud/webhook-test/telegram-errors"
+N8N_RETRY_STATUSES = (502, 503, 504)
+
+# Одно keep-alive соединение на все отчеты вместо TLS-рукопожатия на каждую ошибку
+n8n_client = httpx.AsyncClient(timeout=5, transport=httpx.AsyncHTTPTransport(retries=2))
 
-def report_error(error_description):
-    """Отправляет ошибку в n8n для создания GitHub Issue"""
+async def report_error_async(error_description):
+    """Отправляет ошибку в n8n для создания GitHub Issue, не блокируя event loop"""
     try:
-        requests.post(N8N_WEBHOOK, json={"text": error_description}, timeout=5)
-        print(f"✅ Ошибка отправлена в n8n")
+        for attempt in range(3):
+            response = await n8n_client.post(N8N_WEBHOOK, json={"text": error_description})
+            if response.status_code not in N8N_RETRY_STATUSES:
+                break
+            await asyncio.sleep(0.2 * 2 ** attempt)
+        if response.is_success:
+            print("✅ Ошибка отправлена в n8n")
+        else:
+            print(f"❌ n8n не принял ошибку: HTTP {response.status_code} (попыток: {attempt + 1})")
     except Exception as e:
         print(f"❌ Не удалось отправить ошибку в n8n: {e}")
-# ====================================
 
-import httpx
+# Ссылки на фоновые отчеты, чтобы задачи не собрал GC до завершения
+error_report_tasks = set()
+
+def _error_report_done(task):
+    error_report_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"❌ Фоновый отчет об ошибке упал: {task.exception()}")
+
+def report_error_background(error_description):
+    """Отправляет отчет в фоне: пользователь получает извинение, не дожидаясь n8n"""
+    task = asyncio.create_task(report_error_async(error_description))
+    error_report_tasks.add(task)
+    task.add_done_callback(_error_report_done)
+# ====================================
 
 # Создаем клиент с явными настройками (если доступен ключ)
 if ANTHROPIC_API_KEY:
-    client = anthropic.Anthropic(
+    # Общий пул keep-alive соединений к api.anthropic.com; HTTP/2 мультиплексирует параллельные запросы
+    anthropic_http = httpx.AsyncClient(
+        # Держим простаивающие соединения 5 минут: паузы между сообщениями не стоят нового TLS-рукопожатия
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=500, keepalive_expiry=300),
+        timeout=httpx.Timeout(60.0, connect=10.0),
+        http2=True
+    )
+    client = anthropic.AsyncAnthropic(
         api_key=ANTHROPIC_API_KEY,
         max_retries=2,
-        timeout=httpx.Timeout(60.0, connect=10.0)
+        timeout=httpx.Timeout(60.0, connect=10.0),
+        default_headers={"anthropic-beta": "prompt-caching-2024-07-31"},
+        http_client=anthropic_http
     )
 else:
+    anthropic_http = None
     client = None
 
 DEFAULT_MODEL = os.environ.get("ANTHROPIC_MODEL", "claude-3-5-sonnet-20241022")
+SUMMARY_MODEL = os.environ.get("ANTHROPIC_SUMMARY_MODEL", "claude-3-5-haiku-20241022")
+# Распознавание фото: сначала быстрая модель, при сомнительном результате - точная
+OCR_FAST_MODEL = os.environ.get("ANTHROPIC_OCR_FAST_MODEL", "claude-3-5-haiku-20241022")
+OCR_MODEL = os.environ.get("ANTHROPIC_OCR_MODEL", "claude-sonnet-4-20250514")
+OCR_ESCALATE_IMAGE_BYTES = 200 * 1024
 
 class SessionState(Enum):
     WAITING_TASK = "waiting_task"
@@ -78,11 +125,10 @@ SYSTEM_PROMPT = """Ты математический наставник, кот
 
 Если ученик просит прямой ответ, объясни ценность самостоятельного решения."""
 
-VERIFICATION_PROMPT = """Ты проверяющий математических решений.
-
-ЗАДАЧА: {original_task}
+# Статичная часть уходит в кэшируемый system-блок, задача и ответ - в сообщение пользователя
+VERIFICATION_PROMPT = """Ты строгий, но справедливый проверяющий математических решений.
 
-ОТВЕТ УЧЕНИКА: {student_answer}
+Ты получишь задачу (ЗАДАЧА) и ответ ученика (ОТВЕТ УЧЕНИКА).
 
 Твоя задача:
 1. Проверь правильность финального ответа
@@ -90,22 +136,54 @@ VERIFICATION_PROMPT = """Ты проверяющий математически
 3. Укажи ошибки если есть
 4. Дай конструктивную обратную связь
 
-Формат ответа (JSON):
-{{
-  "correct": true/false,
-  "final_answer": "правильный ответ",
-  "score": 0-100,
-  "feedback": "детальная обратная связь",
-  "mistakes": ["список ошибок если есть"],
-  "strengths": ["что ученик сделал хорошо"]
-}}"""
+Верни результат проверки через инструмент submit_verdict."""
+
+class Verdict(msgspec.Struct, frozen=True):
+    """Результат проверки решения"""
+    correct: bool
+    final_answer: str = "Не удалось определить"
+    score: int = 0
+    feedback: str = "Нет обратной связи"
+    mistakes: tuple[str, ...] = ()
+    strengths: tuple[str, ...] = ()
+
+def parse_verdict(data: dict) -> Verdict:
+    """Приводит аргументы submit_verdict к Verdict, прощая модели огрехи форматирования.
+
+    Нестрогий режим msgspec принимает "85", 85.0 и "true"; null означает значение по умолчанию
+    (пустой список ошибок), дробную оценку отбрасываем до целого, как раньше делал int().
+    """
+    data = {key: value for key, value in data.items() if value is not None}
+    if isinstance(data.get("score"), float):
+        data["score"] = int(data["score"])
+    return msgspec.convert(data, type=Verdict, strict=False)
+
+# Схема вердикта: Claude обязан вызвать этот инструмент, поэтому ответ всегда структурирован
+VERDICT_TOOL = {
+    "name": "submit_verdict",
+    "description": "Сохранить результат проверки решения ученика",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "correct": {"type": "boolean", "description": "верен ли финальный ответ"},
+            "final_answer": {"type": "string", "description": "правильный ответ"},
+            "score": {"type": "integer", "minimum": 0, "maximum": 100},
+            "feedback": {"type": "string", "description": "детальная обратная связь"},
+            "mistakes": {"type": "array", "items": {"type": "string"}, "description": "список ошибок если есть"},
+            "strengths": {"type": "array", "items": {"type": "string"}, "description": "что ученик сделал хорошо"},
+        },
+        "required": ["correct", "final_answer", "score", "feedback", "mistakes", "strengths"],
+    },
+}
+VERDICT_TOOL_SCHEMA = json.dumps(VERDICT_TOOL, sort_keys=True, ensure_ascii=False)
 
-MEME_GENERATION_PROMPT = """Создай веселый мем-текст для ученика, который только что решил математическую задачу.
+VERIFICATION_REQUEST = """ЗАДАЧА: {original_task}
 
-КОНТЕКСТ:
-- Оценка: {score}/100
-- Задача была: {task_type}
-- Уровень: {difficulty}
+ОТВЕТ УЧЕНИКА: {student_answer}"""
+
+# Неизменная часть промпта мема уходит в кэшируемый system; в сообщении - только КОНТЕКСТ
+MEME_GENERATION_PROMPT = """Создай веселый мем-текст для ученика, который только что решил математическую задачу.
+Контекст (оценка, тип задачи, уровень) придет в сообщении.
 
 ТРЕБОВАНИЯ:
 1. Мем должен быть актуальным и современным (2024-2025)
@@ -124,53 +202,263 @@ MEME_GENERATION_PROMPT = """Создай веселый мем-текст для
 
 Формат ответа - только текст мема, без пояснений."""
 
+# %-подстановка по позиции (оценка, тип задачи, уровень) - без разбора format-спецификации
+MEME_CONTEXT = """КОНТЕКСТ:
+- Оценка: %d/100
+- Задача была: %s
+- Уровень: %s"""
+
+OCR_PROMPT = """Распознай математическую задачу с этого изображения.
+
+ИНСТРУКЦИИ:
+1. Извлеки ТОЛЬКО текст задачи (условие, вопрос)
+2. Сохрани все математические символы, формулы, уравнения
+3. Если есть несколько задач - извлеки все
+4. Если это рукописный текст - постарайся распознать точно
+5. Если на фото нет математической задачи - напиши "НЕТ ЗАДАЧИ"
+
+ФОРМАТ ОТВЕТА:
+Только чистый текст задачи, без комментариев и пояснений.
+
+Примеры правильного формата:
+- Реши уравнение: 2x + 5 = 15
+- Найди производную функции f(x) = x³ - 2x + 1
+- Упрости выражение: (a + b)² - (a - b)²"""
+
+SUMMARY_PROMPT = """Ты помогаешь наставнику по математике не терять контекст длинного диалога.
+
+Сожми переданный фрагмент диалога ученика и наставника в 3-5 предложений:
+- какие шаги решения уже пройдены и к чему пришли
+- где ученик ошибался или застревал
+- на каком вопросе остановились
+
+Пиши на русском языке, без вступлений и пояснений."""
+
 # Математическая клавиатура
 MATH_SYMBOLS = {
-    'basic': ['√', '²', '³', '∫', 'π', '±', '÷', '×'],
-    'greek': ['α', 'β', 'γ', 'δ', 'θ', 'λ', 'μ', 'σ'],
-    'calculus': ['∑', '∏', '∂', '∇', '∞', '≈', '≠', '≤', '≥'],
-    'geometry': ['∠', '°', '⊥', '∥', '△', '□', '○']
+    'basic': ('√', '²', '³', '∫', 'π', '±', '÷', '×'),
+    'greek': ('α', 'β', 'γ', 'δ', 'θ', 'λ', 'μ', 'σ'),
+    'calculus': ('∑', '∏', '∂', '∇', '∞', '≈', '≠', '≤', '≥'),
+    'geometry': ('∠', '°', '⊥', '∥', '△', '□', '○')
+}
+
+def _build_symbol_markup(symbols):
+    """Символы по 4 в ряд плюс кнопка возврата к категориям"""
+    keyboard = [
+        [InlineKeyboardButton(symbol, callback_data=f'sym_{symbol}') for symbol in symbols[i:i + 4]]
+        for i in range(0, len(symbols), 4)
+    ]
+    keyboard.append([InlineKeyboardButton("« Назад", callback_data='back_menu')])
+    return InlineKeyboardMarkup(keyboard)
+
+CATEGORY_MARKUPS = {category: _build_symbol_markup(symbols) for category, symbols in MATH_SYMBOLS.items()}
+
+# Статичные клавиатуры собираются один раз при импорте, а не на каждый апдейт
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📚 Начать решать", callback_data="start_solving")],
+    [InlineKeyboardButton("📊 Моя статистика", callback_data="show_stats")],
+    [InlineKeyboardButton("⚙️ Настройки", callback_data="settings")],
+    [InlineKeyboardButton("❓ Помощь", callback_data="help")]
+])
+
+CATEGORY_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Базовые", callback_data='cat_basic'),
+     InlineKeyboardButton("Греческие", callback_data='cat_greek')],
+    [InlineKeyboardButton("Матанализ", callback_data='cat_calculus'),
+     InlineKeyboardButton("Геометрия", callback_data='cat_geometry')]
+])
+
+SOLVING_START_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Сдать ответ", callback_data="submit_answer")],
+    [InlineKeyboardButton("💡 Подсказка", callback_data="hint")],
+    [InlineKeyboardButton("🔄 Начать заново", callback_data="start_solving")]
+])
+
+SOLVING_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Сдать ответ", callback_data="submit_answer")],
+    [InlineKeyboardButton("💡 Подсказка", callback_data="hint")]
+])
+
+PHOTO_CONFIRM_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Верно, решаем!", callback_data="confirm_task")],
+    [InlineKeyboardButton("✏️ Исправить текст", callback_data="edit_task")],
+    [InlineKeyboardButton("🔄 Другое фото", callback_data="retry_photo")]
+])
+
+RESULT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📚 Новая задача", callback_data="start_solving")],
+    [InlineKeyboardButton("📊 Статистика", callback_data="show_stats")]
+])
+
+BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="start_solving")]])
+
+SYMBOL_COPY_TEXT = {
+    symbol: f'Скопируй символ: {symbol}'
+    for symbols in MATH_SYMBOLS.values()
+    for symbol in symbols
 }
 
+@dataclass(slots=True)
 class UserSession:
-    def __init__(self, user_id):
-        self.user_id = user_id
-        self.state = SessionState.WAITING_TASK
-        self.current_task = None
-        self.conversation = []
-        self.stats = {
-            "total_tasks": 0,
-            "completed_tasks": 0,
-            "average_score": 0,
-            "total_hints": 0,
-            "tasks_history": [],
-            "total_memes_earned": 0
-        }
-        self.difficulty = "medium"
-        self.exam_mode = False
-        self.task_start_time = None
-        self.temp_task = None
-        self.meme_enabled = True
+    # Сколько последних реплик отправляем дословно; более старые сворачиваются в summary_prefix
+    MAX_TURNS: ClassVar[int] = 12
+
+    user_id: int
+    state: SessionState = SessionState.WAITING_TASK
+    current_task: str | None = None
+    # Тип задачи для мема определяется один раз, когда задача принята
+    task_type: str | None = None
+    conversation: list = field(default_factory=list)
+    summary_prefix: str | None = None
+    # Статистика лежит прямо в сессии, без вложенного словаря
+    total_tasks: int = 0
+    completed_tasks: int = 0
+    average_score: float = 0
+    total_hints: int = 0
+    tasks_history: list = field(default_factory=list)
+    total_memes_earned: int = 0
+    difficulty: str = "medium"
+    exam_mode: bool = False
+    task_start_time: float | None = None
+    temp_task: str | None = None
+    meme_enabled: bool = True
+
+    def to_dict(self):
+        data = asdict(self)
+        data["state"] = self.state.value
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data["state"] = SessionState(data["state"])
+        return cls(**data)
+
+# Сессии живут в Redis (переживают рестарт, общие для нескольких воркеров, истекают сами),
+# без REDIS_URL - в памяти процесса
+SESSION_TTL = 24 * 60 * 60
+
+if REDIS_URL:
+    import redis.asyncio as aioredis
+    from redis.exceptions import LockError
+    redis_client = aioredis.from_url(REDIS_URL)
+else:
+    redis_client = None
 
 user_sessions = {}
 
-def get_session(user_id):
-    if user_id not in user_sessions:
-        user_sessions[user_id] = UserSession(user_id)
-    return user_sessions[user_id]
+async def get_session(user_id):
+    if redis_client is None:
+        if user_id not in user_sessions:
+            user_sessions[user_id] = UserSession(user_id)
+        return user_sessions[user_id]
+
+    raw = await redis_client.get(f"session:{user_id}")
+    if raw is None:
+        return UserSession(user_id)
+    return UserSession.from_dict(json.loads(raw))
+
+async def save_session(session):
+    """Записывает сессию обратно в Redis; в режиме памяти объект уже изменен на месте"""
+    if redis_client is None:
+        return
+    payload = json.dumps(session.to_dict(), ensure_ascii=False)
+    await redis_client.set(f"session:{session.user_id}", payload, ex=SESSION_TTL)
+
+# Все, кто меняет сессию (воркеры очереди, кнопки, команды, фото), берут блокировку ученика:
+# иначе последний save_session затирает чужие изменения. С Redis блокировка общая для процессов,
+# без него - asyncio.Lock, который удаляется, как только его никто не ждет.
+# Redis-блокировка живет SESSION_LOCK_TIMEOUT секунд и продлевается, пока обработчик работает:
+# стрим ответа или повторы запроса к Claude могут идти дольше любого фиксированного срока,
+# а после падения процесса блокировка сама истечет через минуту
+SESSION_LOCK_TIMEOUT = 60
+user_locks = {}
+
+async def keep_lock_alive(lock):
+    while True:
+        await asyncio.sleep(SESSION_LOCK_TIMEOUT / 3)
+        try:
+            await lock.reacquire()
+        except LockError as e:
+            print(f"⚠️ Блокировка сессии потеряна: {e}")
+            return
+
+@asynccontextmanager
+async def user_lock(user_id):
+    if redis_client is not None:
+        lock = redis_client.lock(f"lock:session:{user_id}", timeout=SESSION_LOCK_TIMEOUT)
+        await lock.acquire()
+        keeper = asyncio.create_task(keep_lock_alive(lock))
+        try:
+            yield
+        finally:
+            keeper.cancel()
+            try:
+                await lock.release()
+            except LockError as e:
+                print(f"⚠️ Блокировка сессии истекла до освобождения: {e}")
+        return
+
+    entry = user_locks.get(user_id)
+    if entry is None:
+        entry = user_locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del user_locks[user_id]
+
+def locks_session(handler):
+    """Выполняет обработчик апдейта под блокировкой сессии ученика"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user is None:
+            return await handler(update, context)
+        async with user_lock(update.effective_user.id):
+            return await handler(update, context)
+    return wrapper
+
+# Кэш ответов Claude для повторяющихся задач: одинаковая задача/ответ/фото -> готовый результат.
+# Ключ - хэш нормализованного текста; хранится в Redis (если есть) или в LRU процесса
+RESPONSE_CACHE_TTL = 7 * 24 * 60 * 60
+RESPONSE_CACHE_SIZE = 1024
+response_cache = OrderedDict()
+
+def normalize_text(text):
+    # Только схлопываем пробелы: регистр в математике значим (X и x, F(x) и f(x))
+    return " ".join(text.split())
+
+def cache_key(kind, *parts):
+    digest = hashlib.sha256("\x1f".join((DEFAULT_MODEL,) + parts).encode("utf-8")).hexdigest()
+    return f"cache:{kind}:{digest}"
+
+async def cache_get(key):
+    if redis_client is not None:
+        value = await redis_client.get(key)
+        return value.decode("utf-8") if value is not None else None
+    value = response_cache.get(key)
+    if value is not None:
+        response_cache.move_to_end(key)
+    return value
+
+async def cache_set(key, value):
+    if redis_client is not None:
+        await redis_client.set(key, value, ex=RESPONSE_CACHE_TTL)
+        return
+    response_cache[key] = value
+    response_cache.move_to_end(key)
+    if len(response_cache) > RESPONSE_CACHE_SIZE:
+        response_cache.popitem(last=False)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
-        session = get_session(user_id)
+        session = await get_session(user_id)
         
-        keyboard = [
-            [InlineKeyboardButton("📚 Начать решать", callback_data="start_solving")],
-            [InlineKeyboardButton("📊 Моя статистика", callback_data="show_stats")],
-            [InlineKeyboardButton("⚙️ Настройки", callback_data="settings")],
-            [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = MAIN_MENU_MARKUP
         
         await update.message.reply_text(
             "👋 Привет! Я твой математический наставник.\n\n"
@@ -187,6 +475,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
     except Exception as e:
+        import traceback
         error_text = f"""Ошибка в команде /start:
 
 **Текст ошибки:** {str(e)}
@@ -198,167 +487,145 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ```
 {traceback.format_exc()}
 ```"""
-        report_error(error_text)
+        report_error_background(error_text)
         await update.message.reply_text("😔 Произошла ошибка при запуске. Попробуйте еще раз.")
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    user_id = update.effective_user.id
-    session = get_session(user_id)
-    
-    # Обработка математических символов
+    # Точное совпадение callback_data, иначе - по префиксу до первого "_" (cat_, sym_, difficulty_)
     data = query.data
-    
-    if data.startswith('cat_'):
-        category = data.replace('cat_', '')
-        symbols = MATH_SYMBOLS.get(category, [])
-        
-        keyboard = []
-        row = []
-        for i, symbol in enumerate(symbols):
-            row.append(InlineKeyboardButton(symbol, callback_data=f'sym_{symbol}'))
-            if len(row) == 4 or i == len(symbols) - 1:
-                keyboard.append(row)
-                row = []
-        
-        keyboard.append([InlineKeyboardButton("« Назад", callback_data='back_menu')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(f'Символы ({category}):', reply_markup=reply_markup)
+    handler = BUTTON_HANDLERS.get(data)
+    if handler is not None:
+        args = ()
+    else:
+        prefix, sep, arg = data.partition("_")
+        handler = BUTTON_PREFIX_HANDLERS.get(prefix + sep)
+        args = (arg,)
+    if handler is None:
         return
     
-    elif data.startswith('sym_'):
-        symbol = data.replace('sym_', '')
-        await query.edit_message_text(f'Скопируй символ: {symbol}')
+    # Клавиатура символов не зависит от сессии
+    if handler in STATELESS_BUTTONS:
+        await handler(query, None, *args)
         return
     
-    elif data == 'back_menu':
-        keyboard = [
-            [InlineKeyboardButton("Базовые", callback_data='cat_basic'),
-             InlineKeyboardButton("Греческие", callback_data='cat_greek')],
-            [InlineKeyboardButton("Матанализ", callback_data='cat_calculus'),
-             InlineKeyboardButton("Геометрия", callback_data='cat_geometry')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text('Выбери категорию:', reply_markup=reply_markup)
+    async with user_lock(update.effective_user.id):
+        session = await get_session(update.effective_user.id)
+        await handler(query, session, *args)
+        await save_session(session)
+
+async def show_symbol_category(query, session, category):
+    reply_markup = CATEGORY_MARKUPS.get(category) or _build_symbol_markup(())
+    await query.edit_message_text(f'Символы ({category}):', reply_markup=reply_markup)
+
+async def show_symbol(query, session, symbol):
+    await query.edit_message_text(SYMBOL_COPY_TEXT.get(symbol) or f'Скопируй символ: {symbol}')
+
+async def show_symbol_menu(query, session):
+    await query.edit_message_text('Выбери категорию:', reply_markup=CATEGORY_MENU_MARKUP)
+
+async def start_solving(query, session):
+    session.state = SessionState.WAITING_TASK
+    await query.edit_message_text(
+        "📝 Отлично! Отправь мне математическую задачу:\n\n"
+        "✍️ Напиши текстом\n"
+        "📸 Или пришли фото с задачей\n\n"
+        "Примеры:\n"
+        "• Реши уравнение: 3x + 7 = 22\n"
+        "• Найди производную: f(x) = x² + 3x - 5\n"
+        "• Упрости: (2x + 3)(x - 4)"
+    )
+
+async def set_difficulty(query, session, difficulty):
+    session.difficulty = difficulty
+    await query.edit_message_text(
+        f"✅ Уровень сложности изменен на: {difficulty}\n\n"
+        "Отправь задачу для начала!"
+    )
+
+async def toggle_exam(query, session):
+    session.exam_mode = not session.exam_mode
+    mode = "включен" if session.exam_mode else "выключен"
+    await query.edit_message_text(
+        f"🎓 Режим экзамена {mode}\n\n"
+        f"{'В этом режиме подсказки ограничены' if session.exam_mode else 'Обычный режим с полными подсказками'}"
+    )
+
+async def toggle_memes(query, session):
+    session.meme_enabled = not session.meme_enabled
+    status = "включены" if session.meme_enabled else "выключены"
+    await query.edit_message_text(
+        f"🎭 Мемы {status}\n\n"
+        f"{'Будешь получать веселые мемы за решенные задачи!' if session.meme_enabled else 'Мемы отключены. Серьезный режим.'}"
+    )
+
+async def request_final_answer(query, session):
+    session.state = SessionState.FINAL_ANSWER
+    await query.edit_message_text(
+        "✍️ Отлично! Теперь напиши свой ФИНАЛЬНЫЙ ОТВЕТ на задачу.\n\n"
+        "Постарайся написать полное решение с обоснованием."
+    )
+
+async def confirm_task(query, session):
+    if not session.temp_task:
         return
+    task_text = session.temp_task
+    session.temp_task = None
     
-    # Остальная обработка кнопок
-    if query.data == "start_solving":
-        session.state = SessionState.WAITING_TASK
-        await query.edit_message_text(
-            "📝 Отлично! Отправь мне математическую задачу:\n\n"
-            "✍️ Напиши текстом\n"
-            "📸 Или пришли фото с задачей\n\n"
-            "Примеры:\n"
-            "• Реши уравнение: 3x + 7 = 22\n"
-            "• Найди производную: f(x) = x² + 3x - 5\n"
-            "• Упрости: (2x + 3)(x - 4)"
-        )
-    
-    elif query.data == "show_stats":
-        await show_statistics(query, session)
-    
-    elif query.data == "settings":
-        await show_settings(query, session)
-    
-    elif query.data == "help":
-        await show_help(query)
+    session.current_task = task_text
+    session.task_type = classify_task(task_text)
+    session.conversation = []
+    session.summary_prefix = None
+    session.state = SessionState.SOLVING
+    session.task_start_time = time.time()
+    session.total_tasks += 1
     
-    elif query.data.startswith("difficulty_"):
-        difficulty = query.data.replace("difficulty_", "")
-        session.difficulty = difficulty
-        await query.edit_message_text(
-            f"✅ Уровень сложности изменен на: {difficulty}\n\n"
-            "Отправь задачу для начала!"
-        )
+    session.conversation.append({
+        "role": "user",
+        "content": f"Ученик хочет решить задачу: {task_text}\n\nНачни с проверки понимания условия задачи."
+    })
     
-    elif query.data == "toggle_exam":
-        session.exam_mode = not session.exam_mode
-        mode = "включен" if session.exam_mode else "выключен"
-        await query.edit_message_text(
-            f"🎓 Режим экзамена {mode}\n\n"
-            f"{'В этом режиме подсказки ограничены' if session.exam_mode else 'Обычный режим с полными подсказками'}"
-        )
+    response = await get_ai_response(session, SYSTEM_PROMPT)
     
-    elif query.data == "toggle_memes":
-        session.meme_enabled = not session.meme_enabled
-        status = "включены" if session.meme_enabled else "выключены"
-        await query.edit_message_text(
-            f"🎭 Мемы {status}\n\n"
-            f"{'Будешь получать веселые мемы за решенные задачи!' if session.meme_enabled else 'Мемы отключены. Серьезный режим.'}"
-        )
+    await query.edit_message_text(
+        f"📝 Отлично! Начинаем решать!\n\n{response}",
+        reply_markup=SOLVING_START_MARKUP
+    )
+
+async def edit_task(query, session):
+    await query.edit_message_text(
+        "✏️ Хорошо! Напиши правильный текст задачи вручную."
+    )
+    session.state = SessionState.WAITING_TASK
+
+async def retry_photo(query, session):
+    await query.edit_message_text(
+        "📸 Хорошо! Отправь новое фото задачи."
+    )
+    session.state = SessionState.WAITING_TASK
+
+async def give_hint(query, session):
+    if session.state != SessionState.SOLVING:
+        await query.answer("Сначала начни решать задачу!", show_alert=True)
+        return
     
-    elif query.data == "submit_answer":
-        session.state = SessionState.FINAL_ANSWER
-        await query.edit_message_text(
-            "✍️ Отлично! Теперь напиши свой ФИНАЛЬНЫЙ ОТВЕТ на задачу.\n\n"
-            "Постарайся написать полное решение с обоснованием."
-        )
+    session.total_hints += 1
     
-    elif query.data == "confirm_task":
-        if hasattr(session, 'temp_task'):
-            task_text = session.temp_task
-            delattr(session, 'temp_task')
-            
-            session.current_task = task_text
-            session.conversation = []
-            session.state = SessionState.SOLVING
-            session.task_start_time = datetime.now()
-            session.stats["total_tasks"] += 1
-            
-            session.conversation.append({
-                "role": "user",
-                "content": f"Ученик хочет решить задачу: {task_text}\n\nНачни с проверки понимания условия задачи."
-            })
-            
-            response = await get_ai_response(session, SYSTEM_PROMPT)
-            
-            keyboard = [
-                [InlineKeyboardButton("✅ Сдать ответ", callback_data="submit_answer")],
-                [InlineKeyboardButton("💡 Подсказка", callback_data="hint")],
-                [InlineKeyboardButton("🔄 Начать заново", callback_data="start_solving")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                f"📝 Отлично! Начинаем решать!\n\n{response}",
-                reply_markup=reply_markup
-            )
-    
-    elif query.data == "edit_task":
-        await query.edit_message_text(
-            "✏️ Хорошо! Напиши правильный текст задачи вручную."
-        )
-        session.state = SessionState.WAITING_TASK
+    session.conversation.append({
+        "role": "user",
+        "content": "Мне нужна подсказка. Дай небольшую подсказку, но не решение."
+    })
     
-    elif query.data == "retry_photo":
-        await query.edit_message_text(
-            "📸 Хорошо! Отправь новое фото задачи."
-        )
-        session.state = SessionState.WAITING_TASK
+    live = LiveReply(query.message, "💡 ")
+    response = await get_ai_response(session, SYSTEM_PROMPT, on_text=live.update)
     
-    elif query.data == "hint":
-        if session.state != SessionState.SOLVING:
-            await query.answer("Сначала начни решать задачу!", show_alert=True)
-            return
-        
-        session.stats["total_hints"] += 1
-        
-        session.conversation.append({
-            "role": "user",
-            "content": "Мне нужна подсказка. Дай небольшую подсказку, но не решение."
-        })
-        
-        response = await get_ai_response(session, SYSTEM_PROMPT)
-        
-        await query.message.reply_text(f"💡 {response}")
+    await live.finish(response)
 
 async def show_statistics(query, session):
     text = build_statistics_text(session)
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="start_solving")]]
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text(text, reply_markup=BACK_MARKUP)
 
 async def show_settings(query, session):
     difficulty_emoji = {
@@ -418,23 +685,44 @@ async def show_help(query):
 💪 Чем больше решаешь сам - 
 тем лучше учишься!"""
     
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="start_solving")]]
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text(text, reply_markup=BACK_MARKUP)
+
+async def show_help_button(query, session):
+    await show_help(query)
+
+# Таблицы кнопок: callback_data -> обработчик(query, session[, аргумент после префикса])
+BUTTON_HANDLERS = {
+    "back_menu": show_symbol_menu,
+    "start_solving": start_solving,
+    "show_stats": show_statistics,
+    "settings": show_settings,
+    "help": show_help_button,
+    "toggle_exam": toggle_exam,
+    "toggle_memes": toggle_memes,
+    "submit_answer": request_final_answer,
+    "confirm_task": confirm_task,
+    "edit_task": edit_task,
+    "retry_photo": retry_photo,
+    "hint": give_hint,
+}
+
+BUTTON_PREFIX_HANDLERS = {
+    "cat_": show_symbol_category,
+    "sym_": show_symbol,
+    "difficulty_": set_difficulty,
+}
+
+STATELESS_BUTTONS = frozenset((show_symbol_category, show_symbol, show_symbol_menu, show_help_button))
 
 async def keyboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("Базовые", callback_data='cat_basic'),
-         InlineKeyboardButton("Греческие", callback_data='cat_greek')],
-        [InlineKeyboardButton("Матанализ", callback_data='cat_calculus'),
-         InlineKeyboardButton("Геометрия", callback_data='cat_geometry')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = CATEGORY_MENU_MARKUP
     await update.message.reply_text('Выбери категорию символов:', reply_markup=reply_markup)
 
+@locks_session
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
-        session = get_session(user_id)
+        session = await get_session(user_id)
         
         if session.state not in [SessionState.WAITING_TASK, SessionState.SOLVING]:
             await update.message.reply_text(
@@ -446,15 +734,22 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.chat.send_action("typing")
         
         photo = update.message.photo[-1]
-        photo_file = await context.bot.get_file(photo.file_id)
+        # То же фото (например, пересланное) распознаем один раз; модели и промпт OCR в ключе,
+        # чтобы их смена не отдавала старые распознавания
+        ocr_key = cache_key("ocr", OCR_FAST_MODEL, OCR_MODEL, OCR_PROMPT, photo.file_unique_id)
+        recognized_text = await cache_get(ocr_key)
         
-        photo_bytes = io.BytesIO()
-        await photo_file.download_to_memory(photo_bytes)
-        photo_bytes.seek(0)
-        
-        image_data = base64.standard_b64encode(photo_bytes.read()).decode("utf-8")
-        
-        recognized_text = await recognize_math_from_image(image_data)
+        if recognized_text is None:
+            photo_file = await context.bot.get_file(photo.file_id)
+            
+            import base64
+
+            photo_bytes = await photo_file.download_as_bytearray()
+            image_data = base64.b64encode(photo_bytes).decode("ascii")
+            
+            recognized_text = await recognize_math_from_image(image_data)
+            if recognized_text:
+                await cache_set(ocr_key, recognized_text)
         
         if not recognized_text:
             await update.message.reply_text(
@@ -467,14 +762,10 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        keyboard = [
-            [InlineKeyboardButton("✅ Верно, решаем!", callback_data="confirm_task")],
-            [InlineKeyboardButton("✏️ Исправить текст", callback_data="edit_task")],
-            [InlineKeyboardButton("🔄 Другое фото", callback_data="retry_photo")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = PHOTO_CONFIRM_MARKUP
         
         session.temp_task = recognized_text
+        await save_session(session)
         
         await update.message.reply_text(
             f"📝 Я распознал такую задачу:\n\n"
@@ -485,6 +776,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
     except Exception as e:
+        import traceback
         error_text = f"""Ошибка в handle_photo:
 
 **Текст ошибки:** {str(e)}
@@ -496,82 +788,81 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ```
 {traceback.format_exc()}
 ```"""
-        report_error(error_text)
+        report_error_background(error_text)
         
         await update.message.reply_text(
             "😔 Не удалось обработать фото. Попробуй еще раз или напиши задачу текстом."
         )
 
+async def ocr_request(model: str, image_base64: str, max_tokens: int) -> str:
+    message = await client.messages.create(
+        model=model,
+        max_tokens=max_tokens,
+        # Инструкция одинакова для всех фото - идет в кэшируемый system-блок перед изображением
+        system=[{"type": "text", "text": OCR_PROMPT, "cache_control": {"type": "ephemeral"}}],
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image",
+                        "source": {
+                            "type": "base64",
+                            "media_type": "image/jpeg",
+                            "data": image_base64,
+                        },
+                    }
+                ],
+            }
+        ],
+    )
+    return message.content[0].text.strip()
+
+
 async def recognize_math_from_image(image_base64):
+    """Сначала читает фото быстрой моделью, на сомнительном результате переспрашивает большую"""
     if not client:
         return None
 
     try:
-        def _request():
-            return client.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=1024,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": "image/jpeg",
-                                    "data": image_base64,
-                                },
-                            },
-                            {
-                                "type": "text",
-                                "text": """Распознай математическую задачу с этого изображения.
-
-ИНСТРУКЦИИ:
-1. Извлеки ТОЛЬКО текст задачи (условие, вопрос)
-2. Сохрани все математические символы, формулы, уравнения
-3. Если есть несколько задач - извлеки все
-4. Если это рукописный текст - постарайся распознать точно
-5. Если на фото нет математической задачи - напиши "НЕТ ЗАДАЧИ"
-
-ФОРМАТ ОТВЕТА:
-Только чистый текст задачи, без комментариев и пояснений.
-
-Примеры правильного формата:
-- Реши уравнение: 2x + 5 = 15
-- Найди производную функции f(x) = x³ - 2x + 1
-- Упрости выражение: (a + b)² - (a - b)²"""
-                        }
-                    ],
-                }
-            ],
-            )
-
-        message = await asyncio.to_thread(_request)
-
-        recognized_text = message.content[0].text.strip()
+        try:
+            recognized_text = await ocr_request(OCR_FAST_MODEL, image_base64, 512)
+        except Exception as e:
+            print(f"Ошибка быстрого распознавания ({OCR_FAST_MODEL}): {e}")
+            recognized_text = ""
+
+        # Большая фотография с почти пустым результатом - скорее всего сложная запись
+        image_bytes = len(image_base64) * 3 // 4
+        if (
+            not recognized_text
+            or "НЕТ ЗАДАЧИ" in recognized_text.upper()
+            or (len(recognized_text) < 10 and image_bytes > OCR_ESCALATE_IMAGE_BYTES)
+        ):
+            recognized_text = await ocr_request(OCR_MODEL, image_base64, 1024)
         
         if "НЕТ ЗАДАЧИ" in recognized_text.upper():
             return None
             
         return recognized_text
-        
     except Exception as e:
         print(f"Ошибка распознавания: {e}")
         return None
 
+@locks_session
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
         user_message = update.message.text
-        session = get_session(user_id)
+        session = await get_session(user_id)
         
         if session.state == SessionState.WAITING_TASK:
             session.current_task = user_message
+            session.task_type = classify_task(user_message)
             session.conversation = []
+            session.summary_prefix = None
             session.state = SessionState.SOLVING
-            session.task_start_time = datetime.now()
-            session.stats["total_tasks"] += 1
+            session.task_start_time = time.time()
+            session.total_tasks += 1
             
             session.conversation.append({
                 "role": "user",
@@ -580,19 +871,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             await update.message.chat.send_action("typing")
             
-            response = await get_ai_response(session, SYSTEM_PROMPT)
+            live = LiveReply(update.message, "📝 Задача принята!\n\n")
+            response = await get_ai_response(session, SYSTEM_PROMPT, on_text=live.update)
+            await save_session(session)
             
-            keyboard = [
-                [InlineKeyboardButton("✅ Сдать ответ", callback_data="submit_answer")],
-                [InlineKeyboardButton("💡 Подсказка", callback_data="hint")],
-                [InlineKeyboardButton("🔄 Начать заново", callback_data="start_solving")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = SOLVING_START_MARKUP
             
-            await update.message.reply_text(
-                f"📝 Задача принята!\n\n{response}",
-                reply_markup=reply_markup
-            )
+            await live.finish(response, reply_markup=reply_markup)
             return
         
         if session.state == SessionState.SOLVING:
@@ -603,15 +888,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             await update.message.chat.send_action("typing")
             
-            response = await get_ai_response(session, SYSTEM_PROMPT)
+            live = LiveReply(update.message)
+            response = await get_ai_response(session, SYSTEM_PROMPT, on_text=live.update)
+            await save_session(session)
             
-            keyboard = [
-                [InlineKeyboardButton("✅ Сдать ответ", callback_data="submit_answer")],
-                [InlineKeyboardButton("💡 Подсказка", callback_data="hint")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = SOLVING_MARKUP
             
-            await update.message.reply_text(response, reply_markup=reply_markup)
+            await live.finish(response, reply_markup=reply_markup)
             return
         
         if session.state == SessionState.FINAL_ANSWER:
@@ -620,79 +903,87 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             verification = await verify_solution(session.current_task, user_message)
             
-            task_time = (datetime.now() - session.task_start_time).seconds // 60
-            session.stats["completed_tasks"] += 1
+            task_time = int(time.time() - session.task_start_time) // 60
+            session.completed_tasks += 1
             
-            old_avg = session.stats["average_score"]
-            new_score = verification["score"]
-            total = session.stats["completed_tasks"]
-            session.stats["average_score"] = (old_avg * (total - 1) + new_score) / total
+            old_avg = session.average_score
+            new_score = verification.score
+            total = session.completed_tasks
+            session.average_score = (old_avg * (total - 1) + new_score) / total
             
-            session.stats["tasks_history"].append({
-                "date": datetime.now().strftime("%d.%m"),
+            session.tasks_history.append({
+                # День храним числом (дни с эпохи), в строку превращаем только при показе статистики
+                "day": int(time.time() // 86400),
                 "score": new_score,
                 "time": task_time,
                 "task_preview": session.current_task[:30] + "..." if len(session.current_task) > 30 else session.current_task
             })
             
-            await update.message.chat.send_action("typing")
-            meme_text = await generate_meme_text(new_score, session.current_task, session.difficulty)
+            # Мем зависит только от оценки: генерируем его параллельно с отправкой результата
+            meme_task = None
+            if session.meme_enabled:
+                session.total_memes_earned += 1
+                task_type = session.task_type or classify_task(session.current_task)
+                cached_meme = meme_cache_key(new_score, task_type, session.difficulty) in meme_cache
+                if MEME_BATCH_ENABLED and client and not cached_meme:
+                    queue_meme(update.effective_chat.id, new_score, task_type, session.difficulty)
+                else:
+                    meme_task = asyncio.create_task(
+                        generate_meme_text(new_score, task_type, session.difficulty)
+                    )
             
             emoji = "🎉" if new_score >= 80 else "👍" if new_score >= 60 else "💪"
             result_text = f"""{emoji} ПРОВЕРКА ЗАВЕРШЕНА
 
 📝 Задача: {session.current_task[:50]}...
 
-✅ Правильность: {"Верно!" if verification['correct'] else "Есть ошибки"}
+✅ Правильность: {"Верно!" if verification.correct else "Есть ошибки"}
 ⭐ Оценка: {new_score}/100
 ⏱ Время: {task_time} мин
 
 📊 ОБРАТНАЯ СВЯЗЬ:
-{verification['feedback']}
+{verification.feedback}
 
 """
             
-            if verification.get('strengths'):
+            if verification.strengths:
                 result_text += "💪 ЧТО ХОРОШО:\n"
-                for s in verification['strengths']:
+                for s in verification.strengths:
                     result_text += f"• {s}\n"
                 result_text += "\n"
             
-            if verification.get('mistakes'):
+            if verification.mistakes:
                 result_text += "⚠️ НАД ЧЕМ ПОРАБОТАТЬ:\n"
-                for m in verification['mistakes']:
+                for m in verification.mistakes:
                     result_text += f"• {m}\n"
             
-            if not verification['correct']:
-                result_text += f"\n✏️ Правильный ответ: {verification['final_answer']}"
+            if not verification.correct:
+                result_text += f"\n✏️ Правильный ответ: {verification.final_answer}"
             
-            keyboard = [
-                [InlineKeyboardButton("📚 Новая задача", callback_data="start_solving")],
-                [InlineKeyboardButton("📊 Статистика", callback_data="show_stats")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = RESULT_MARKUP
             
             session.state = SessionState.COMPLETED
             
             await update.message.reply_text(result_text, reply_markup=reply_markup)
             
-            if session.meme_enabled:
-                session.stats["total_memes_earned"] = session.stats.get("total_memes_earned", 0) + 1
-
+            if meme_task is not None:
                 await update.message.chat.send_action("typing")
-                await asyncio.sleep(1)
+                meme_text, _ = await asyncio.gather(meme_task, asyncio.sleep(1))
 
-                meme_emoji = "🎯" if new_score >= 80 else "🙂" if new_score >= 60 else "😢"
                 if meme_text:
-                    await update.message.reply_text(f"{meme_emoji} {meme_text}")
+                    await update.message.reply_text(format_meme(new_score, meme_text))
 
             # Сбрасываем состояние после завершения задачи
             session.current_task = None
+            session.task_type = None
             session.conversation = []
+            session.summary_prefix = None
             session.task_start_time = None
             session.state = SessionState.WAITING_TASK
+            await save_session(session)
             
     except Exception as e:
+        import traceback
         error_text = f"""Ошибка в handle_message:
 
 **Текст ошибки:** {str(e)}
@@ -706,35 +997,82 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 {traceback.format_exc()}
 ```"""
         
-        report_error(error_text)
+        report_error_background(error_text)
         
         await update.message.reply_text(
             "😔 Произошла ошибка. Я уже сообщил разработчику!"
         )
 
 
-def build_statistics_text(session: UserSession) -> str:
-    stats = session.stats
+# ========== ОЧЕРЕДЬ ЗАДАНИЙ ДЛЯ CLAUDE ==========
+# Обработчик апдейта только ставит сообщение в очередь, а Claude вызывают воркеры:
+# при наплыве (весь класс сдает домашку разом) прием апдейтов не встает.
+# С REDIS_URL очередь - список в Redis (общий для нескольких процессов), иначе - в памяти
+CLAUDE_QUEUE = "queue:claude"
+CLAUDE_WORKERS = int(os.environ.get("CLAUDE_WORKERS", "8"))
+
+local_queue = asyncio.Queue()
+worker_tasks = []
+
 
-    if stats["total_tasks"] == 0:
+async def enqueue_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.chat.send_action("typing")
+    if redis_client is not None:
+        await redis_client.lpush(CLAUDE_QUEUE, update.to_json())
+    else:
+        await local_queue.put(update)
+
+
+async def claude_worker(application: Application):
+    while True:
+        try:
+            if redis_client is not None:
+                _, raw = await redis_client.brpop(CLAUDE_QUEUE)
+                update = Update.de_json(json.loads(raw), application.bot)
+            else:
+                update = await local_queue.get()
+
+            context = application.context_types.context.from_update(update, application)
+            # handle_message сам берет блокировку ученика, поэтому сессию пишет один обработчик за раз.
+            # Порядок сообщений одного ученика сохраняется только в режиме памяти (asyncio.Lock - FIFO);
+            # с Redis два воркера могут взять соседние сообщения и получить блокировку в любом порядке
+            await handle_message(update, context)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Ошибка воркера очереди: {e}")
+
+
+async def start_workers(application: Application) -> None:
+    load_meme_cache()
+    for _ in range(CLAUDE_WORKERS):
+        worker_tasks.append(asyncio.create_task(claude_worker(application)))
+    if MEME_BATCH_ENABLED and client:
+        worker_tasks.append(asyncio.create_task(meme_batcher(application)))
+# ================================================
+
+
+def build_statistics_text(session: UserSession) -> str:
+    if session.total_tasks == 0:
         return "📊 Статистика пока пуста.\n\nРеши несколько задач, чтобы увидеть свой прогресс!"
 
-    success_rate = (stats["completed_tasks"] / stats["total_tasks"] * 100) if stats["total_tasks"] else 0
+    success_rate = (session.completed_tasks / session.total_tasks * 100) if session.total_tasks else 0
 
     text = (
         "📊 ТВОЯ СТАТИСТИКА\n\n"
-        f"✅ Решено задач: {stats['completed_tasks']}/{stats['total_tasks']}\n"
-        f"⭐ Средний балл: {stats['average_score']:.1f}/100\n"
-        f"💡 Использовано подсказок: {stats['total_hints']}\n"
-        f"🎭 Заработано мемов: {stats.get('total_memes_earned', 0)}\n"
+        f"✅ Решено задач: {session.completed_tasks}/{session.total_tasks}\n"
+        f"⭐ Средний балл: {session.average_score:.1f}/100\n"
+        f"💡 Использовано подсказок: {session.total_hints}\n"
+        f"🎭 Заработано мемов: {session.total_memes_earned}\n"
         f"📈 Процент успеха: {success_rate:.1f}%\n\n"
         "📚 Последние задачи:"
     )
 
-    if stats["tasks_history"]:
-        for task in stats["tasks_history"][-5:]:
+    if session.tasks_history:
+        for task in session.tasks_history[-5:]:
             emoji = "✅" if task["score"] >= 70 else "⚠️" if task["score"] >= 50 else "❌"
-            text += f"\n{emoji} {task['date']}: {task['score']}/100"
+            date = time.strftime("%d.%m", time.gmtime(task["day"] * 86400))
+            text += f"\n{emoji} {date}: {task['score']}/100"
     else:
         text += "\n— пока нет завершенных задач"
 
@@ -742,11 +1080,14 @@ def build_statistics_text(session: UserSession) -> str:
 
 
 async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    session = get_session(update.effective_user.id)
+    session = await get_session(update.effective_user.id)
     session.state = SessionState.WAITING_TASK
     session.current_task = None
+    session.task_type = None
     session.conversation = []
+    session.summary_prefix = None
     session.task_start_time = None
+    await save_session(session)
 
     await update.message.reply_text(
         "🔄 Начнем заново! Отправь новую математическую задачу или фото."
@@ -754,13 +1095,14 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def submit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    session = get_session(update.effective_user.id)
+    session = await get_session(update.effective_user.id)
 
     if session.state != SessionState.SOLVING:
         await update.message.reply_text("Сначала отправь задачу и начни решение.")
         return
 
     session.state = SessionState.FINAL_ANSWER
+    await save_session(session)
     await update.message.reply_text(
         "✍️ Отлично! Теперь напиши свой ФИНАЛЬНЫЙ ОТВЕТ на задачу.\n\n"
         "Постарайся расписать полный ход решения."
@@ -768,67 +1110,202 @@ async def submit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    session = get_session(update.effective_user.id)
+    session = await get_session(update.effective_user.id)
     text = build_statistics_text(session)
     await update.message.reply_text(text)
 
 
 async def hint_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    session = get_session(update.effective_user.id)
+    session = await get_session(update.effective_user.id)
 
     if session.state != SessionState.SOLVING:
         await update.message.reply_text("Подсказки доступны только во время решения задачи.")
         return
 
-    session.stats["total_hints"] += 1
+    session.total_hints += 1
     session.conversation.append({
         "role": "user",
         "content": "Мне нужна подсказка. Дай небольшую подсказку, но не решение."
     })
 
     await update.message.chat.send_action("typing")
-    response = await get_ai_response(session, SYSTEM_PROMPT)
-    await update.message.reply_text(f"💡 {response}")
+    live = LiveReply(update.message, "💡 ")
+    response = await get_ai_response(session, SYSTEM_PROMPT, on_text=live.update)
+    await save_session(session)
+    await live.finish(response)
+
+
+def block_text(block):
+    """Текст блока ответа Claude (объект SDK или dict) или None для нетекстовых блоков"""
+    text = getattr(block, "text", None)
+    if text is not None:
+        return text
+    if isinstance(block, dict) and block.get("type") == "text":
+        return block.get("text", "")
+    return None
+
+
+class LiveReply:
+    """Показывает ответ Claude по мере генерации.
+
+    Сообщение появляется с первыми токенами и дальше редактируется не чаще
+    раза в секунду (лимит Telegram на правки в одном чате).
+    """
+    EDIT_INTERVAL = 1.0
+
+    def __init__(self, message, prefix=""):
+        self.message = message
+        self.prefix = prefix
+        self.sent = None
+        self.last_edit = 0.0
+
+    async def update(self, text):
+        now = time.monotonic()
+        if now - self.last_edit < self.EDIT_INTERVAL:
+            return
+        self.last_edit = now
+        try:
+            await self._show(f"{self.prefix}{text} ▌")
+        except Exception as e:
+            # Промежуточная правка не критична - финальный текст все равно придет
+            print(f"Не удалось обновить сообщение: {e}")
+
+    async def finish(self, text, reply_markup=None):
+        await self._show(f"{self.prefix}{text}", reply_markup)
+
+    async def _show(self, text, reply_markup=None):
+        if self.sent is None:
+            self.sent = await self.message.reply_text(text, reply_markup=reply_markup)
+        else:
+            await self.sent.edit_text(text, reply_markup=reply_markup)
 
 
-async def call_claude(messages, system_prompt: str, max_tokens: int = 600) -> str:
+async def call_claude(messages, system_prompt: str, max_tokens: int = 600, model: str = DEFAULT_MODEL, on_text=None) -> str:
+    """Запрос к Claude; с on_text ответ стримится и on_text получает накопленный текст"""
     if not client:
         raise RuntimeError("Anthropic client is not configured")
 
-    def _request():
-        response = client.messages.create(
-            model=DEFAULT_MODEL,
-            system=system_prompt,
-            messages=messages,
-            max_tokens=max_tokens,
+    request = dict(
+        model=model,
+        # Статичный system-промпт кэшируется на стороне Anthropic (5 минут)
+        system=[{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}],
+        messages=messages,
+        max_tokens=max_tokens,
+    )
+    if on_text is None:
+        response = await client.messages.create(**request)
+    else:
+        async with client.messages.stream(**request) as stream:
+            buffer = ""
+            async for text in stream.text_stream:
+                buffer += text
+                await on_text(buffer)
+            response = await stream.get_final_message()
+
+    log_cache_usage(response)
+    texts = map(block_text, getattr(response, "content", None) or ())
+    return "\n".join(text for text in texts if text is not None).strip()
+
+
+async def call_claude_tool(messages, system_prompt: str, tool: dict, max_tokens: int = 600, model: str = DEFAULT_MODEL) -> dict:
+    """Запрос к Claude с обязательным вызовом tool; возвращает аргументы вызова как dict"""
+    if not client:
+        raise RuntimeError("Anthropic client is not configured")
+
+    response = await client.messages.create(
+        model=model,
+        system=[{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}],
+        messages=messages,
+        max_tokens=max_tokens,
+        tools=[tool],
+        tool_choice={"type": "tool", "name": tool["name"]},
+    )
+    log_cache_usage(response)
+
+    for block in getattr(response, "content", None) or ():
+        if getattr(block, "type", None) == "tool_use":
+            return block.input
+    raise RuntimeError(f"Claude did not call {tool['name']}")
+
+
+def log_cache_usage(response) -> None:
+    cached_tokens = getattr(getattr(response, "usage", None), "cache_read_input_tokens", None)
+    if cached_tokens:
+        print(f"♻️ Prompt cache: прочитано {cached_tokens} токенов из кэша")
+
+
+async def compact_conversation(session: UserSession) -> None:
+    """Сворачивает реплики старше MAX_TURNS в краткое резюме дешевой моделью.
+
+    Сжимаем блоками: только когда история доросла до 2*MAX_TURNS, и сразу обрезаем до MAX_TURNS.
+    Так одно резюме (и закэшированный префикс диалога) живет несколько ходов подряд,
+    а не пересчитывается перед каждым ответом.
+    """
+    if len(session.conversation) <= 2 * session.MAX_TURNS:
+        return
+
+    old_turns = session.conversation[:-session.MAX_TURNS]
+    transcript = "\n".join(
+        f"{'Ученик' if turn['role'] == 'user' else 'Наставник'}: {turn['content']}"
+        for turn in old_turns
+    )
+    if session.summary_prefix:
+        transcript = f"Ранее: {session.summary_prefix}\n\n{transcript}"
+
+    try:
+        summary = await call_claude(
+            [{"role": "user", "content": [{"type": "text", "text": transcript}]}],
+            SUMMARY_PROMPT,
+            max_tokens=300,
+            model=SUMMARY_MODEL,
         )
+    except Exception:
+        # Не удалось сжать - отправим историю целиком, попробуем на следующем ходу
+        return
 
-        parts = []
-        for block in getattr(response, "content", []) or []:
-            text = getattr(block, "text", None)
-            if text is not None:
-                parts.append(text)
-            elif isinstance(block, dict) and block.get("type") == "text":
-                parts.append(block.get("text", ""))
-        return "\n".join(parts).strip()
+    session.summary_prefix = summary
+    session.conversation = session.conversation[-session.MAX_TURNS:]
 
-    return await asyncio.to_thread(_request)
 
+async def get_ai_response(session: UserSession, system_prompt: str, on_text=None) -> str:
+    if client:
+        await compact_conversation(session)
 
-async def get_ai_response(session: UserSession, system_prompt: str) -> str:
-    # Преобразуем историю в формат Anthropic
+    # Преобразуем историю в формат Anthropic; старые ходы заменяет резюме с условием задачи
     messages = []
+    if session.summary_prefix:
+        messages.append({
+            "role": "user",
+            "content": [{
+                "type": "text",
+                "text": f"Задача: {session.current_task}\n\nКратко о предыдущем диалоге: {session.summary_prefix}"
+            }]
+        })
     for turn in session.conversation:
         messages.append({
             "role": turn["role"],
             "content": [{"type": "text", "text": turn["content"]}]
         })
 
+    # Кэшируем растущий префикс диалога: метки на двух последних репликах ученика
+    # (вместе с system-блоком это 3 из 4 допустимых точек кэширования)
+    user_turns = [m for m in messages if m["role"] == "user"]
+    for message in user_turns[-2:]:
+        message["content"][-1]["cache_control"] = {"type": "ephemeral"}
+
+    # Первый ход по одной и той же задаче одинаков для всех учеников
+    opener_key = None
+    if len(session.conversation) == 1 and not session.summary_prefix:
+        opener_key = cache_key("opener", system_prompt, normalize_text(session.conversation[0]["content"]))
+
     try:
-        if client:
-            reply = await call_claude(messages, system_prompt)
-        else:
-            raise RuntimeError("Anthropic client unavailable")
+        reply = await cache_get(opener_key) if opener_key else None
+        if reply is None:
+            if not client:
+                raise RuntimeError("Anthropic client unavailable")
+            reply = await call_claude(messages, system_prompt, on_text=on_text)
+            if opener_key:
+                await cache_set(opener_key, reply)
     except Exception:
         # Фолбэк, чтобы бот продолжал работать даже без LLM
         reply = (
@@ -841,8 +1318,22 @@ async def get_ai_response(session: UserSession, system_prompt: str) -> str:
     return reply
 
 
-async def verify_solution(task_text: str, student_answer: str) -> dict:
-    prompt = VERIFICATION_PROMPT.format(
+# Вердикт офлайн-режима один на всех: Verdict неизменяемый, поэтому копировать не нужно
+OFFLINE_VERDICT = Verdict(
+    correct=False,
+    final_answer="н/д",
+    score=50,
+    feedback=(
+        "Пока не могу проверить решение автоматически."
+        " Попробуй самостоятельно оценить ответ или повтори попытку позже."
+    ),
+    mistakes=("Проверка выполнена в офлайн-режиме",),
+    strengths=(),
+)
+
+
+async def verify_solution(task_text: str, student_answer: str) -> Verdict:
+    prompt = VERIFICATION_REQUEST.format(
         original_task=task_text,
         student_answer=student_answer
     )
@@ -852,86 +1343,303 @@ async def verify_solution(task_text: str, student_answer: str) -> dict:
             "role": "user",
             "content": [{"type": "text", "text": prompt}]
         }]
+        # Промпт и схема в ключе: после их правки старые вердикты не переиспользуются
+        key = cache_key(
+            "verify", VERIFICATION_PROMPT, VERDICT_TOOL_SCHEMA,
+            normalize_text(task_text), normalize_text(student_answer),
+        )
         try:
-            response = await call_claude(messages, "Ты строгий, но справедливый проверяющий.")
-            data = json.loads(response)
-            # Гарантируем обязательные поля
-            return {
-                "correct": bool(data.get("correct", False)),
-                "final_answer": data.get("final_answer", "Не удалось определить"),
-                "score": int(data.get("score", 0)),
-                "feedback": data.get("feedback", "Нет обратной связи"),
-                "mistakes": data.get("mistakes", []),
-                "strengths": data.get("strengths", []),
-            }
+            cached = await cache_get(key)
+            if cached is not None:
+                return msgspec.json.decode(cached, type=Verdict)
+            # Вердикт приходит аргументами submit_verdict - парсить текст модели не нужно,
+            # msgspec только проверяет типы полей
+            result = parse_verdict(await call_claude_tool(messages, VERIFICATION_PROMPT, VERDICT_TOOL))
+            await cache_set(key, msgspec.json.encode(result).decode("utf-8"))
+            return result
         except Exception:
             pass
 
-    # Фолбэк, если LLM недоступен или ответ некорректен
-    return {
-        "correct": False,
-        "final_answer": "н/д",
-        "score": 50,
-        "feedback": (
-            "Пока не могу проверить решение автоматически."
-            " Попробуй самостоятельно оценить ответ или повтори попытку позже."
-        ),
-        "mistakes": ["Проверка выполнена в офлайн-режиме"],
-        "strengths": [],
-    }
+    # Фолбэк, если LLM недоступен
+    return OFFLINE_VERDICT
 
 
-async def generate_meme_text(score: int, task_text: str, difficulty: str) -> str:
-    if client:
-        prompt = MEME_GENERATION_PROMPT.format(
-            score=score,
-            task_type="текстовая задача" if len(task_text) > 40 else "быстрый пример",
-            difficulty=difficulty,
-        )
-        messages = [{
-            "role": "user",
-            "content": [{"type": "text", "text": prompt}]
-        }]
+# Фолбэк-мемы по порогам оценки: <40, 40-59, 60-79, 80+
+FALLBACK_MEME_THRESHOLDS = (40, 60, 80)
+FALLBACK_MEMES = (
+    "Это не провал, это монтаж тренировки. В следующий раз точно разнесешь!",
+    "Мы это засчитаем. Маленькие победы тоже считаются!",
+    "W-победа! Еще пару шагов — и станешь легендой алгебры.",
+    "Gigachad момент! Математика сама решается, когда ты рядом.",
+)
+
+
+def classify_task(task_text: str) -> str:
+    return "текстовая задача" if len(task_text) > 40 else "быстрый пример"
+
+
+def meme_messages(score: int, task_type: str, difficulty: str) -> list:
+    prompt = MEME_CONTEXT % (score, task_type, difficulty)
+    return [{
+        "role": "user",
+        "content": [{"type": "text", "text": prompt}]
+    }]
+
+
+# Промпт мема зависит только от (десятка баллов, тип задачи, сложность) - пространство
+# ключей маленькое, поэтому готовые мемы кэшируются и переживают рестарт через файл
+MEME_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tmp", "meme_cache.json")
+MEME_CACHE_SIZE = 512
+meme_cache = OrderedDict()
+
+
+def meme_cache_key(score: int, task_type: str, difficulty: str) -> str:
+    return f"{score // 10}|{task_type}|{difficulty}"
+
+
+def remember_meme(key: str, meme_text: str) -> None:
+    meme_cache[key] = meme_text
+    meme_cache.move_to_end(key)
+    if len(meme_cache) > MEME_CACHE_SIZE:
+        meme_cache.popitem(last=False)
+
+
+def load_meme_cache() -> None:
+    try:
+        with open(MEME_CACHE_PATH, encoding="utf-8") as f:
+            meme_cache.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"⚠️ Не удалось загрузить кэш мемов: {e}")
+
+
+def save_meme_cache() -> None:
+    try:
+        os.makedirs(os.path.dirname(MEME_CACHE_PATH), exist_ok=True)
+        with open(MEME_CACHE_PATH, "w", encoding="utf-8") as f:
+            json.dump(meme_cache, f, ensure_ascii=False)
+    except Exception as e:
+        print(f"⚠️ Не удалось сохранить кэш мемов: {e}")
+
+
+MEME_DEADLINE = 1.5
+meme_prefetch_tasks = set()
+
+
+def store_prefetched_meme(key: str, task) -> None:
+    meme_prefetch_tasks.discard(task)
+    if task.cancelled() or task.exception() is not None:
+        return
+    if task.result():
+        remember_meme(key, task.result())
+
+
+def format_meme(score: int, meme_text: str) -> str:
+    meme_emoji = "🎯" if score >= 80 else "🙂" if score >= 60 else "😢"
+    return f"{meme_emoji} {meme_text}"
+
+
+async def generate_meme_text_offline(score: int, task_type: str, difficulty: str) -> str:
+    """Фолбэк без LLM"""
+    return FALLBACK_MEMES[bisect_right(FALLBACK_MEME_THRESHOLDS, score)]
+
+
+async def generate_meme_text_online(score: int, task_type: str, difficulty: str) -> str:
+    key = meme_cache_key(score, task_type, difficulty)
+    meme_text = meme_cache.get(key)
+    if meme_text is not None:
+        meme_cache.move_to_end(key)
+        return meme_text
+    task = asyncio.create_task(call_claude(meme_messages(score, task_type, difficulty), MEME_GENERATION_PROMPT))
+    meme_prefetch_tasks.add(task)
+    task.add_done_callback(lambda done: store_prefetched_meme(key, done))
+    try:
+        # Медленный ответ не держит ученика: отдаем заготовку, а мем дозреет в кэш для следующего раза
+        meme_text = await asyncio.wait_for(asyncio.shield(task), MEME_DEADLINE)
+        if meme_text:
+            return meme_text
+    except Exception:
+        pass
+    return await generate_meme_text_offline(score, task_type, difficulty)
+
+
+# Наличие клиента известно при старте - выбираем реализацию один раз, а не на каждый вызов
+generate_meme_text = generate_meme_text_online if client else generate_meme_text_offline
+
+
+# ========== ПАКЕТНАЯ ГЕНЕРАЦИЯ МЕМОВ ==========
+# Мем не срочный, поэтому с MEME_BATCH=1 запросы копятся и уходят в Message Batches API
+# (вдвое дешевле по токенам); готовые мемы досылаются отдельным сообщением
+MEME_BATCH_ENABLED = os.environ.get("MEME_BATCH", "0") == "1"
+MEME_BATCH_INTERVAL = 30
+MEME_BATCH_FLUSH_SIZE = 50
+MEME_BATCH_MAX = 100
+MEME_BATCH_POLL_INTERVAL = 30
+
+pending_memes = []
+meme_flush_event = asyncio.Event()
+meme_batch_tasks = set()
+
+
+def queue_meme(chat_id: int, score: int, task_type: str, difficulty: str) -> None:
+    pending_memes.append({
+        "chat_id": chat_id,
+        "score": score,
+        "task_type": task_type,
+        "difficulty": difficulty,
+    })
+    if len(pending_memes) >= MEME_BATCH_FLUSH_SIZE:
+        meme_flush_event.set()
+
+
+async def meme_batcher(application: Application) -> None:
+    """Раз в MEME_BATCH_INTERVAL секунд (или при заполнении) отправляет накопленные мемы пакетом"""
+    while True:
         try:
-            return await call_claude(messages, "Создай короткий и позитивный мем.")
-        except Exception:
+            await asyncio.wait_for(meme_flush_event.wait(), timeout=MEME_BATCH_INTERVAL)
+        except asyncio.TimeoutError:
             pass
+        meme_flush_event.clear()
 
-    # Фолбэк без LLM
-    if score >= 80:
-        return "Gigachad момент! Математика сама решается, когда ты рядом."
-    if score >= 60:
-        return "W-победа! Еще пару шагов — и станешь легендой алгебры."
-    if score >= 40:
-        return "Мы это засчитаем. Маленькие победы тоже считаются!"
-    return "Это не провал, это монтаж тренировки. В следующий раз точно разнесешь!"
+        while pending_memes:
+            items = pending_memes[:MEME_BATCH_MAX]
+            del pending_memes[:MEME_BATCH_MAX]
+            task = asyncio.create_task(deliver_meme_batch(application.bot, items))
+            meme_batch_tasks.add(task)
+            task.add_done_callback(meme_batch_tasks.discard)
 
 
-def register_handlers(application: Application) -> None:
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("reset", reset_command))
-    application.add_handler(CommandHandler("submit", submit_command))
-    application.add_handler(CommandHandler("stats", stats_command))
-    application.add_handler(CommandHandler("hint", hint_command))
-    application.add_handler(CommandHandler("keyboard", keyboard_command))
+async def deliver_meme_batch(bot, items: list) -> None:
+    try:
+        batch = await client.beta.messages.batches.create(requests=[
+            {
+                "custom_id": str(i),
+                "params": {
+                    "model": DEFAULT_MODEL,
+                    "max_tokens": 600,
+                    "system": [{"type": "text", "text": MEME_GENERATION_PROMPT, "cache_control": {"type": "ephemeral"}}],
+                    "messages": meme_messages(item["score"], item["task_type"], item["difficulty"]),
+                },
+            }
+            for i, item in enumerate(items)
+        ])
+        while batch.processing_status != "ended":
+            await asyncio.sleep(MEME_BATCH_POLL_INTERVAL)
+            batch = await client.beta.messages.batches.retrieve(batch.id)
+
+        memes = {}
+        async for entry in await client.beta.messages.batches.results(batch.id):
+            if entry.result.type == "succeeded":
+                texts = map(block_text, entry.result.message.content)
+                memes[entry.custom_id] = "\n".join(text for text in texts if text is not None).strip()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"❌ Ошибка пакетной генерации мемов: {e}")
+        memes = {}
+
+    for i, item in enumerate(items):
+        meme_text = memes.get(str(i))
+        if meme_text:
+            remember_meme(meme_cache_key(item["score"], item["task_type"], item["difficulty"]), meme_text)
+        else:
+            meme_text = await generate_meme_text(item["score"], item["task_type"], item["difficulty"])
+        try:
+            await bot.send_message(item["chat_id"], format_meme(item["score"], meme_text))
+        except Exception as e:
+            print(f"❌ Не удалось отправить мем: {e}")
+# ==============================================
+
+
+# Текст без команд; фильтр собирается один раз, а не при каждом create_application
+TEXT_NON_COMMAND_FILTER = filters.TEXT & ~filters.COMMAND
+
+
+# Команды разбираются одним обработчиком: поиск в словаре вместо перебора CommandHandler'ов
+COMMANDS = {
+    "start": start,
+    "reset": reset_command,
+    "submit": submit_command,
+    "stats": stats_command,
+    "hint": hint_command,
+    "keyboard": keyboard_command,
+}
+
+
+async def dispatch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # "/start@my_bot аргументы" -> ("start", "my_bot")
+    command, _, bot_name = update.effective_message.text.split(maxsplit=1)[0][1:].partition("@")
+    # В группах команда с чужим @username адресована другому боту
+    if bot_name and bot_name.lower() != context.bot.username.lower():
+        return
+    handler = COMMANDS.get(command.lower())
+    if handler is not None:
+        async with user_lock(update.effective_user.id):
+            await handler(update, context)
 
-    application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+
+def register_handlers(application: Application) -> None:
+    application.add_handlers([
+        MessageHandler(filters.COMMAND, dispatch_command),
+        CallbackQueryHandler(button_handler),
+        MessageHandler(filters.PHOTO, handle_photo),
+        MessageHandler(TEXT_NON_COMMAND_FILTER, enqueue_message),
+    ])
+
+
+async def close_clients(application: Application) -> None:
+    tasks = worker_tasks + list(meme_batch_tasks) + list(meme_prefetch_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    save_meme_cache()
+    if anthropic_http is not None:
+        await anthropic_http.aclose()
+    await n8n_client.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
 
 
 def create_application() -> Application:
     if not TELEGRAM_TOKEN:
         raise RuntimeError("TELEGRAM_TOKEN is not configured")
 
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        # Соблюдает лимиты Telegram на отправку (~30 сообщений/с всего, 20/мин в группу)
+        .rate_limiter(AIORateLimiter())
+        # Апдейты разных учеников обрабатываются параллельно: ожидание блокировки одного ученика
+        # (пока воркер ждет Claude) или inline-вызов Claude в кнопке/фото не стопорит остальных.
+        # Все, кто пишет сессию, уже сериализованы через user_lock
+        .concurrent_updates(True)
+        .post_init(start_workers)
+        .post_shutdown(close_clients)
+        .build()
+    )
     register_handlers(application)
     return application
 
 
 def main():
+    # uvloop быстрее стандартного цикла событий; на Windows его нет - остаемся на asyncio
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     application = create_application()
-    application.run_polling()
+    if PUBLIC_URL:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=TELEGRAM_TOKEN,
+            webhook_url=f"{PUBLIC_URL.rstrip('/')}/{TELEGRAM_TOKEN}",
+        )
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":